@@ -1,10 +1,86 @@
 import os
+import hashlib
+import threading
+from typing import Any
+import orjson
 from crewai import LLM
 from crewai import Agent, Crew, Process, Task
 from crewai.project import CrewBase, agent, crew, task
 from feature_request_to_pr_automation.tools import RepoReaderTool, CreatePullRequestTool
 
 
+class CachedLLM(LLM):
+    """LLM that returns stored responses for prompts it has already answered.
+
+    Responses are keyed by a SHA-256 of the model settings and full message list,
+    and kept per namespace so one agent's answers are never served to another.
+    For Anthropic models the static system prompt (role, backstory, tool schemas)
+    is also marked with a cache_control breakpoint so it is KV-cached server-side.
+    """
+
+    _cache: dict[str, dict[str, str]] = {}
+    _cache_lock = threading.Lock()
+    # Per namespace; the worker keeps one crew alive across jobs, so evict the oldest answers
+    _cache_max_entries = 256
+
+    def __init__(self, *args: Any, namespace: str = "default", **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.namespace = namespace
+
+    def _cache_key(self, messages: Any) -> str:
+        # Serialized on every call, and the message list grows with each agent turn
+        payload = orjson.dumps(
+            {"model": self.model, "temperature": self.temperature, "messages": messages},
+            option=orjson.OPT_SORT_KEYS,
+            default=str,
+        )
+        return hashlib.sha256(payload).hexdigest()
+
+    def _prepare_completion_params(self, messages: Any, tools: Any = None) -> dict[str, Any]:
+        params = super()._prepare_completion_params(messages, tools)
+        if self.is_anthropic:
+            params["messages"] = [
+                {
+                    **msg,
+                    "content": [
+                        {"type": "text", "text": msg["content"], "cache_control": {"type": "ephemeral"}}
+                    ],
+                }
+                if msg.get("role") == "system" and isinstance(msg.get("content"), str)
+                else msg
+                for msg in params["messages"]
+            ]
+        return params
+
+    def call(
+        self,
+        messages: Any,
+        tools: Any = None,
+        callbacks: Any = None,
+        available_functions: Any = None,
+        from_task: Any = None,
+        from_agent: Any = None,
+    ) -> Any:
+        # Native function calling executes tools inside the call; never skip those side effects
+        if tools or available_functions:
+            return super().call(messages, tools, callbacks, available_functions, from_task, from_agent)
+
+        key = self._cache_key(messages)
+        with self._cache_lock:
+            cached = self._cache.get(self.namespace, {}).get(key)
+        if cached is not None:
+            return cached
+
+        answer = super().call(messages, tools, callbacks, available_functions, from_task, from_agent)
+        if isinstance(answer, str) and answer:
+            with self._cache_lock:
+                entries = self._cache.setdefault(self.namespace, {})
+                if len(entries) >= self._cache_max_entries:
+                    entries.pop(next(iter(entries)))
+                entries[key] = answer
+        return answer
+
+
 @CrewBase
 class FeatureRequestToPrAutomationCrew:
     """FeatureRequestToPrAutomation crew"""
@@ -20,7 +96,8 @@ class FeatureRequestToPrAutomationCrew:
             ],
             reasoning=False,
             inject_date=True,
-            llm=LLM(
+            llm=CachedLLM(
+                namespace="feature_request_processor",
                 model="claude-3-7-sonnet-20250219",
                 temperature=0.7,
             ),
@@ -35,9 +112,10 @@ class FeatureRequestToPrAutomationCrew:
             tools=tools_for_analyst,
             reasoning=False,
             inject_date=True,
-            llm=LLM(
-                model="claude-3-7-sonnet-20250219",
-                temperature=0.7,
+            llm=CachedLLM(
+                namespace="github_repository_analyst",
+                model="claude-3-5-haiku-20241022",
+                temperature=0.0,
             ),
         )
     
@@ -51,7 +129,8 @@ class FeatureRequestToPrAutomationCrew:
             ],
             reasoning=False,
             inject_date=True,
-            llm=LLM(
+            llm=CachedLLM(
+                namespace="code_implementation_specialist",
                 model="claude-3-7-sonnet-20250219",
                 temperature=0.7,
             ),
@@ -64,9 +143,10 @@ class FeatureRequestToPrAutomationCrew:
             tools=[CreatePullRequestTool()],
             reasoning=False,
             inject_date=True,
-            llm=LLM(
-                model="claude-3-7-sonnet-20250219",
-                temperature=0.7,
+            llm=CachedLLM(
+                namespace="github_pull_request_manager",
+                model="claude-3-5-haiku-20241022",
+                temperature=0.0,
             ),
         )
     
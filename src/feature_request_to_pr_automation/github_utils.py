@@ -0,0 +1,40 @@
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from github import Github
+
+
+# PyGithub's requester reuses a single connection object that is not safe to share between
+# threads, so each thread gets its own client. Its clients live as long as the thread does,
+# so long-lived pool threads keep their connections open across calls.
+_clients = threading.local()
+
+
+def thread_client(token: Optional[str], **options: Any) -> Github:
+    """Return the calling thread's Github client for ``token`` and ``options``, creating it once."""
+    clients: Optional[Dict[Tuple[Any, ...], Github]] = getattr(_clients, "by_key", None)
+    if clients is None:
+        clients = _clients.by_key = {}
+    key = (token, tuple(sorted(options.items())))
+    client = clients.get(key)
+    if client is None:
+        client = Github(login_or_token=token, **options) if token else Github(**options)
+        clients[key] = client
+    return client
+
+
+def conditional_get(
+    requester: Any,
+    url: str,
+    etag: Optional[str],
+    parameters: Optional[Dict[str, Any]] = None,
+) -> Tuple[Optional[str], Any]:
+    """GET ``url``, revalidating with If-None-Match when a previous ETag is known.
+
+    Returns ``(etag, data)``. ``data`` is None when GitHub answers 304 Not Modified, in which
+    case the caller's stored copy is still current; 304s don't count against the rate limit.
+    """
+    headers = {"If-None-Match": etag} if etag else None
+    response_headers, data = requester.requestJsonAndCheck("GET", url, parameters=parameters, headers=headers)
+    # 304 Not Modified comes back with an empty body
+    return response_headers.get("etag"), data
@@ -11,6 +11,7 @@ def run():
     """
     Run the crew.
     """
+    import asyncio
     import os
     inputs = {
         'feature_title': 'Update navbar CTA label',
@@ -20,7 +21,7 @@ def run():
         'additional_context': 'Next.js app with a Navbar component; likely a button near Sign In.',
         'github_repo_url': os.getenv('GITHUB_REPO_URL', 'sample_value')
     }
-    FeatureRequestToPrAutomationCrew().crew().kickoff(inputs=inputs)
+    asyncio.run(FeatureRequestToPrAutomationCrew().crew().kickoff_async(inputs=inputs))
 
 
 def train():
@@ -1,9 +1,271 @@
+import base64
+import hashlib
+import io
+import json
+import math
 import os
-from typing import List, Optional, Type
-
+import random
+import re
+import tarfile
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Type, TypeVar
+
+import requests
 from crewai.tools import BaseTool
 from pydantic import BaseModel, Field, model_validator
-from github import Github, GithubException
+from github import Github, GithubException, InputGitTreeElement, RateLimitExceededException
+from urllib3.util import Retry
+
+from feature_request_to_pr_automation.github_utils import conditional_get, thread_client
+
+
+_TREE_CACHE_PATH = os.path.expanduser(
+    os.getenv("REPO_TREE_CACHE_PATH", "~/.cache/feature_request_to_pr_automation/repo_trees.json")
+)
+_tree_cache: Optional[Dict[str, Dict[str, Any]]] = None
+_tree_cache_lock = threading.Lock()
+_CONTENT_FETCH_WORKERS = 16
+# Long-lived so its threads, and the per-thread clients below, keep their connections open
+_content_pool = ThreadPoolExecutor(max_workers=_CONTENT_FETCH_WORKERS, thread_name_prefix="repo-contents")
+
+# crewAI runs async tasks on a fresh thread each kickoff, so a client cached on the calling
+# thread would never be reused; tool bodies run here instead, where threads and clients persist
+_TOOL_WORKERS = 4
+_tool_pool = ThreadPoolExecutor(max_workers=_TOOL_WORKERS, thread_name_prefix="repo-tools")
+
+# Raw file bytes keyed by (owner_repo, commit_sha, path); commit SHAs are immutable
+_FILE_CACHE_MAX_ENTRIES = 512
+_file_cache: Dict[Tuple[str, str, str], bytes] = {}
+_file_cache_lock = threading.Lock()
+
+_RETRY_STATUSES = {403, 429, 500, 502, 503, 504}
+_RETRY_BASE_DELAY = 1.0
+_RETRY_JITTER = 1.0
+_RETRY_MAX_WAIT = 60.0
+_CONNECTION_RETRY = Retry(total=3, connect=3, read=3, status=0, backoff_factor=0.5)
+
+T = TypeVar("T")
+
+
+def _retry_after_seconds(e: GithubException) -> Optional[float]:
+    headers = e.headers or {}
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    reset = headers.get("x-ratelimit-reset")
+    if headers.get("x-ratelimit-remaining") == "0" and reset:
+        try:
+            return max(float(reset) - time.time(), 0.0)
+        except ValueError:
+            pass
+    return None
+
+
+def _gh_retry(fn: Callable[..., T], *args: Any, max_attempts: int = 5, **kwargs: Any) -> T:
+    """Call a PyGithub method, backing off on throttling and transient gateway errors.
+
+    Honors Retry-After / X-RateLimit-Reset, otherwise waits exponentially with jitter.
+    Waits longer than _RETRY_MAX_WAIT re-raise so a tool call never hangs on a long reset.
+    """
+    for attempt in range(max_attempts):
+        try:
+            return fn(*args, **kwargs)
+        except GithubException as e:
+            if e.status not in _RETRY_STATUSES or attempt == max_attempts - 1:
+                raise
+            retry_after = _retry_after_seconds(e)
+            if e.status == 403 and retry_after is None and not isinstance(e, RateLimitExceededException):
+                raise  # Permission error, not throttling
+            delay = max(retry_after or 0.0, _RETRY_BASE_DELAY * 2 ** attempt) + random.uniform(0, _RETRY_JITTER)
+            if delay > _RETRY_MAX_WAIT:
+                raise
+            time.sleep(delay)
+    raise AssertionError("unreachable")
+
+
+def _github_token() -> Optional[str]:
+    return os.getenv("GITHUB_TOKEN") or os.getenv("GH_TOKEN") or os.getenv("GITHUB_PAT")
+
+
+def _github_client(token: Optional[str]) -> Github:
+    # HTTP statuses are left to _gh_retry so its wait cap holds; urllib3 still retries
+    # dropped connections and read timeouts, which never reach _gh_retry as GithubException
+    return thread_client(token, per_page=100, retry=_CONNECTION_RETRY)
+
+
+def _load_tree_cache() -> Dict[str, Dict[str, Any]]:
+    global _tree_cache
+    if _tree_cache is None:
+        try:
+            with open(_TREE_CACHE_PATH, "r", encoding="utf-8") as fh:
+                _tree_cache = json.load(fh)
+        except (OSError, ValueError):
+            _tree_cache = {}
+    return _tree_cache
+
+
+def _store_tree_cache(key: str, etag: str, tree: Dict[str, Any]) -> None:
+    with _tree_cache_lock:
+        cache = _load_tree_cache()
+        cache[key] = {"etag": etag, "tree": tree}
+        try:
+            os.makedirs(os.path.dirname(_TREE_CACHE_PATH), exist_ok=True)
+            tmp_path = f"{_TREE_CACHE_PATH}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as fh:
+                json.dump(cache, fh)
+            os.replace(tmp_path, _TREE_CACHE_PATH)
+        except OSError:
+            pass  # Cache is best-effort; the in-memory copy still serves this process
+
+
+def _get_recursive_tree(repo: Any, branch: str) -> Dict[str, Any]:
+    """Fetch the recursive tree for a branch in one request, revalidating via ETag."""
+    key = f"{repo.full_name}@{branch}"
+    with _tree_cache_lock:
+        cached = _load_tree_cache().get(key)
+
+    url = f"{repo.url}/git/trees/{urllib.parse.quote(branch)}"
+    etag, data = _gh_retry(
+        conditional_get, repo._requester, url, cached["etag"] if cached else None, parameters={"recursive": "1"}
+    )
+    if data is None and cached:
+        return cached["tree"]
+
+    if etag:
+        _store_tree_cache(key, etag, data)
+    return data or {}
+
+
+def _fetch_tarball_snippets(repo: Any, ref: str, paths: List[str], max_bytes: int) -> Dict[str, str]:
+    """Read the given paths from one streamed tarball of ``ref`` instead of per-file API calls."""
+    wanted = set(paths)
+    snippets: Dict[str, str] = {}
+    url = _gh_retry(repo.get_archive_link, "tarball", ref=ref)
+    with requests.get(url, stream=True, timeout=60) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+        with tarfile.open(fileobj=resp.raw, mode="r|gz") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                # Members live under a "{owner}-{repo}-{sha}/" top-level directory
+                path = member.name.split("/", 1)[-1]
+                if path not in wanted:
+                    continue
+                fh = tar.extractfile(member)
+                if fh is None:
+                    continue
+                snippets[path] = fh.read(max_bytes).decode("utf-8", errors="ignore")
+                if len(snippets) == len(wanted):
+                    break
+    return snippets
+
+
+def _cache_file(owner_repo: str, commit_sha: str, path: str, content: bytes) -> None:
+    with _file_cache_lock:
+        if len(_file_cache) >= _FILE_CACHE_MAX_ENTRIES:
+            _file_cache.pop(next(iter(_file_cache)))
+        _file_cache[(owner_repo, commit_sha, path)] = content
+
+
+def _read_file_at(repo: Any, commit_sha: str, path: str) -> bytes:
+    """Return the raw file bytes at a commit, served from memory when already read."""
+    key = (repo.full_name, commit_sha, path)
+    with _file_cache_lock:
+        cached = _file_cache.get(key)
+    if cached is not None:
+        return cached
+    existing = _gh_retry(repo.get_contents, path, ref=commit_sha)
+    content = existing.decoded_content or b""
+    _cache_file(repo.full_name, commit_sha, path, content)
+    return content
+
+
+def _apply_replacements(data: bytes, edits: List[Tuple[str, str, Optional[int]]]) -> bytes:
+    """Apply (find_text, replace_text, count) edits to raw file bytes in one left-to-right scan.
+
+    Patterns are UTF-8 encoded once and matched on the bytes, so the file is never decoded.
+    Every find_text is matched against the original data, so one edit's output is never
+    rescanned by another. A count of None (or negative) replaces all occurrences.
+    """
+    edits_b = [(f.encode("utf-8"), r.encode("utf-8"), count) for f, r, count in edits]
+    if len(edits_b) == 1 or any(not find_b for find_b, _, _ in edits_b):
+        for find_b, replace_b, count in edits_b:
+            data = data.replace(find_b, replace_b, -1 if count is None else count)
+        return data
+
+    # Longest patterns first so a find_text containing another wins at the same position
+    remaining = [None if count is None or count < 0 else count for _, _, count in edits_b]
+    active = sorted((i for i in range(len(edits_b)) if remaining[i] != 0), key=lambda i: -len(edits_b[i][0]))
+
+    def compile_active() -> "re.Pattern[bytes]":
+        return re.compile(b"|".join(b"(" + re.escape(edits_b[i][0]) + b")" for i in active))
+
+    pattern = compile_active() if active else None
+    out: List[bytes] = []
+    pos = 0
+    while pattern is not None:
+        m = pattern.search(data, pos)
+        if m is None:
+            break
+        i = active[m.lastindex - 1]
+        out.append(data[pos:m.start()])
+        out.append(edits_b[i][1])
+        pos = m.end()
+        if remaining[i] is not None:
+            remaining[i] -= 1
+            if remaining[i] == 0:
+                # Exhausted edits drop out, so the others can still match where they would have
+                active.remove(i)
+                pattern = compile_active() if active else None
+    out.append(data[pos:])
+    return b"".join(out)
+
+
+_TOKEN_RE = re.compile(r"[A-Za-z0-9]+")
+_CAMEL_RE = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+")
+# Query words too common in feature requests to say anything about which file to read
+_STOP_WORDS = frozenset(
+    "a about add all also and any are as at be but by can could do does for from get has have how i if in "
+    "into is it its just like make me more my new not now of on or our please should so some that the "
+    "their them then there these this to too up use us want we when where which will with would you your".split()
+)
+
+
+def _tokenize(text: str) -> List[str]:
+    tokens: List[str] = []
+    for word in _TOKEN_RE.findall(text):
+        tokens.append(word.lower())
+        parts = _CAMEL_RE.findall(word)
+        if len(parts) > 1:
+            tokens.extend(part.lower() for part in parts)
+    return tokens
+
+
+def _score_paths(paths: List[str], query: str, k1: float = 1.5, b: float = 0.75) -> List[float]:
+    """BM25 score of each path (split into directory, name and camelCase parts) against query."""
+    docs = [_tokenize(p) for p in paths]
+    terms = {t for t in _tokenize(query) if len(t) >= 3 and t not in _STOP_WORDS}
+    if not docs or not terms:
+        return [0.0] * len(paths)
+    n = len(docs)
+    avgdl = (sum(len(d) for d in docs) / n) or 1.0
+    df = Counter(t for d in docs for t in set(d) if t in terms)
+    idf = {t: math.log(1 + (n - df[t] + 0.5) / (df[t] + 0.5)) for t in df}
+
+    scores: List[float] = []
+    for d in docs:
+        tf = Counter(d)
+        norm = k1 * (1 - b + b * len(d) / avgdl)
+        scores.append(sum(idf[t] * tf[t] * (k1 + 1) / (tf[t] + norm) for t in idf if t in tf))
+    return scores
 
 
 class RepoReaderInput(BaseModel):
@@ -28,59 +290,130 @@ class RepoReaderInput(BaseModel):
     )
     max_files: int = Field(50, description="Maximum number of files to fetch contents for.")
     max_bytes_per_file: int = Field(100_000, description="Maximum bytes per file to include.")
+    feature_title: Optional[str] = Field(
+        None, description="Title of the feature being implemented; used to rank files by relevance."
+    )
+    feature_description: Optional[str] = Field(
+        None, description="Description of the feature being implemented; used to rank files by relevance."
+    )
 
 
 class RepoReaderTool(BaseTool):
     name: str = "Read repository structure and sample contents"
     description: str = (
-        "Fetch the repository tree and return a concise summary with file list and sample contents. Files are listed alphabetically so the agent can choose, with 'app/page.tsx' pinned first if present."
+        "Fetch the repository tree and return a concise summary with file list and sample contents. Files are listed alphabetically so the agent can choose, with 'app/page.tsx' pinned first if present. "
+        "When feature_title/feature_description are given, files are ranked by relevance to the feature and contents are only included for matching files."
     )
     args_schema: Type[BaseModel] = RepoReaderInput
 
-    def _run(self, owner_repo: str, file_extensions: List[str], max_files: int, max_bytes_per_file: int) -> str:
-        token = os.getenv("GITHUB_TOKEN") or os.getenv("GH_TOKEN") or os.getenv("GITHUB_PAT")
-        gh = Github(login_or_token=token) if token else Github()
+    def _run(
+        self,
+        owner_repo: str,
+        file_extensions: List[str],
+        max_files: int,
+        max_bytes_per_file: int,
+        feature_title: Optional[str] = None,
+        feature_description: Optional[str] = None,
+    ) -> str:
+        return _tool_pool.submit(
+            self._read_repository,
+            owner_repo,
+            file_extensions,
+            max_files,
+            max_bytes_per_file,
+            feature_title,
+            feature_description,
+        ).result()
+
+    def _read_repository(
+        self,
+        owner_repo: str,
+        file_extensions: List[str],
+        max_files: int,
+        max_bytes_per_file: int,
+        feature_title: Optional[str],
+        feature_description: Optional[str],
+    ) -> str:
+        token = _github_token()
+        gh = _github_client(token)
         try:
-            repo = gh.get_repo(owner_repo)
+            repo = _gh_retry(gh.get_repo, owner_repo)
             default_branch = repo.default_branch or "main"
-            ref = repo.get_git_ref(f"heads/{default_branch}")
-            commit = repo.get_git_commit(ref.object.sha)
-            tree = repo.get_git_tree(commit.sha, recursive=True)
+            tree = _get_recursive_tree(repo, default_branch)
         except GithubException as e:
             return f"Failed to read repository {owner_repo}: {e}"
 
-        all_paths = [entry.path for entry in tree.tree if entry.type == "blob"]
-
-        # Filter by extension
-        filtered_paths = [p for p in all_paths if any(p.endswith(ext) for ext in file_extensions)]
+        # Filter blobs by extension in one pass; str.endswith takes the whole tuple natively
+        ext_tuple = tuple(file_extensions)
+        filtered_paths = [
+            entry["path"]
+            for entry in tree.get("tree", [])
+            if entry.get("type") == "blob" and entry["path"].endswith(ext_tuple)
+        ]
 
         # Let the agent decide the next files; only pin likely root page first
         filtered_paths.sort()  # alphabetical for predictability
         pinned = []
         if "app/page.tsx" in filtered_paths:
             pinned.append("app/page.tsx")
+
+        # Rank by lexical relevance to the feature when one is given; ties stay alphabetical
+        query = " ".join(part for part in (feature_title, feature_description) if part)
+        scores = dict(zip(filtered_paths, _score_paths(filtered_paths, query))) if query else {}
+        relevant = {p for p, score in scores.items() if score > 0}
+        if relevant:
+            filtered_paths.sort(key=lambda p: -scores[p])
+            listing = "pinned first if present, then by relevance to the feature"
+        else:
+            listing = "alphabetical, pinned first if present"
+
         # Build final ordered list: pinned first, then the rest excluding pinned
         ordered_paths = pinned + [p for p in filtered_paths if p not in pinned]
         ordered_paths = ordered_paths[: max_files]
+        # With a relevance signal, only spend requests and tokens on files that matched
+        content_paths = [p for p in ordered_paths if p in pinned or p in relevant] if relevant else ordered_paths
 
-        summary_lines: List[str] = []
-        summary_lines.append(f"Repository: {owner_repo}")
-        summary_lines.append(f"Default branch: {default_branch}")
-        summary_lines.append("\nFiles (alphabetical, pinned first if present):")
-        for p in ordered_paths:
-            summary_lines.append(f"- {p}")
-
-        summary_lines.append("\nSample contents (truncated):")
-        for p in ordered_paths:
+        def fetch_snippet(p: str) -> str:
             try:
-                file = repo.get_contents(p, ref=default_branch)
-                content_bytes = file.decoded_content or b""
-                snippet = content_bytes[: max_bytes_per_file].decode("utf-8", errors="ignore")
-                summary_lines.append(f"\n--- BEGIN {p} ---\n{snippet}\n--- END {p} ---")
+                # Runs on a pool thread, so go through that thread's own client
+                _, data = _gh_retry(
+                    _github_client(token).requester.requestJsonAndCheck,
+                    "GET",
+                    f"{repo.url}/contents/{urllib.parse.quote(p)}",
+                    parameters={"ref": default_branch},
+                )
+                content_bytes = base64.b64decode(data.get("content") or b"")
+                return content_bytes[: max_bytes_per_file].decode("utf-8", errors="ignore")
             except Exception as e:
-                summary_lines.append(f"\n--- BEGIN {p} ---\n[Error reading file: {e}]\n--- END {p} ---")
+                return f"[Error reading file: {e}]"
+
+        snippets: Dict[str, str] = {}
+        if content_paths:
+            try:
+                snippets = _fetch_tarball_snippets(repo, default_branch, content_paths, max_bytes_per_file)
+            except Exception:
+                snippets = {}
+
+        # Fall back to concurrent Contents API requests for anything the tarball didn't cover
+        missing = [p for p in content_paths if p not in snippets]
+        if missing:
+            snippets.update(zip(missing, _content_pool.map(fetch_snippet, missing)))
+
+        # Write straight into one buffer rather than building a per-file string for each snippet
+        buf = io.StringIO()
+        buf.write(f"Repository: {owner_repo}\n")
+        buf.write(f"Default branch: {default_branch}\n")
+        buf.write(f"\nFiles ({listing}):")
+        for p in ordered_paths:
+            buf.write(f"\n- {p}")
 
-        return "\n".join(summary_lines)
+        buf.write("\n\nSample contents (truncated):")
+        for p in content_paths:
+            buf.write(f"\n\n--- BEGIN {p} ---\n")
+            buf.write(snippets[p])
+            buf.write(f"\n--- END {p} ---")
+
+        return buf.getvalue()
 
 
 class FileChange(BaseModel):
@@ -115,14 +448,17 @@ class CreatePullRequestInput(BaseModel):
     owner_repo: str = Field(..., description="Repository in owner/repo format.")
     title: str = Field(..., description="Pull request title.")
     body: str = Field(..., description="Pull request body/description.")
-    branch_name: Optional[str] = Field(None, description="Name of the feature branch to create.")
+    branch_name: Optional[str] = Field(None, description="Name of the feature branch to create. Leave unset to derive one from the request, so retries reuse the same branch and PR.")
     base_branch: Optional[str] = Field(None, description="Base branch to target, defaults to repo default.")
     changes: Optional[List[FileChange]] = Field(
         None, description="List of file changes to commit on the branch."
     )
     replacements: Optional[List[SurgicalReplacement]] = Field(
         None,
-        description="List of surgical find/replace edits to apply to files (preferred for minimal diffs).",
+        description=(
+            "List of surgical find/replace edits to apply to files (preferred for minimal diffs). "
+            "Edits to the same file are all matched against its current content."
+        ),
     )
 
 
@@ -143,27 +479,49 @@ class CreatePullRequestTool(BaseTool):
         branch_name: Optional[str] = None,
         base_branch: Optional[str] = None,
     ) -> str:
-        token = os.getenv("GITHUB_TOKEN") or os.getenv("GH_TOKEN") or os.getenv("GITHUB_PAT")
+        return _tool_pool.submit(
+            self._create_pull_request, owner_repo, title, body, changes, replacements, branch_name, base_branch
+        ).result()
+
+    def _create_pull_request(
+        self,
+        owner_repo: str,
+        title: str,
+        body: str,
+        changes: Optional[List[dict]],
+        replacements: Optional[List[dict]],
+        branch_name: Optional[str],
+        base_branch: Optional[str],
+    ) -> str:
+        token = _github_token()
         if not token:
             return "Missing GitHub token. Set GITHUB_TOKEN in your environment."
 
-        gh = Github(login_or_token=token)
+        gh = _github_client(token)
         try:
-            repo = gh.get_repo(owner_repo)
+            repo = _gh_retry(gh.get_repo, owner_repo)
             base = base_branch or repo.default_branch or "main"
 
-            base_ref = repo.get_git_ref(f"heads/{base}")
+            base_ref = _gh_retry(repo.get_git_ref, f"heads/{base}")
             base_sha = base_ref.object.sha
 
-            branch = branch_name or f"auto/pr-{abs(hash(title)) % 10_000_000}"
+            branch = branch_name or f"auto/pr-{self._content_key(title, body, changes, replacements)}"
             ref_name = f"refs/heads/{branch}"
             try:
-                repo.get_git_ref(f"heads/{branch}")
+                branch_ref = _gh_retry(repo.get_git_ref, f"heads/{branch}")
+                branch_existed = True
             except GithubException:
-                repo.create_git_ref(ref=ref_name, sha=base_sha)
+                branch_ref = _gh_retry(repo.create_git_ref, ref=ref_name, sha=base_sha)
+                branch_existed = False
+
+            # Final content per path; everything lands in a single commit at the end
+            pending: Dict[str, bytes] = {}
+            commit_message = title
 
             # Prefer surgical replacements for minimal diffs
             if replacements:
+                # Group edits by file so each file is read once and rewritten in a single scan
+                edits_by_path: Dict[str, List[Tuple[str, str, Optional[int]]]] = {}
                 for rep in replacements:
                     # Accept dicts or SurgicalReplacement objects
                     if isinstance(rep, dict):
@@ -180,42 +538,33 @@ class CreatePullRequestTool(BaseTool):
                     if not path or find_text is None or replace_text is None:
                         return "Invalid replacement item: require 'path', 'find_text', 'replace_text' (or aliases 'file_path', 'find', 'replace')"
 
-                    # Read existing file from base branch first (or from working branch if exists)
-                    try:
+                    edits_by_path.setdefault(path, []).append((find_text, replace_text, count))
+
+                # A derived branch is keyed by this exact request, so its edits always apply to
+                # the base: a retry rebuilds the same tree and _commit_files skips the commit.
+                # An explicit branch may carry earlier work, so edit on top of its head.
+                read_shas = [base_sha] if not branch_name else [branch_ref.object.sha, base_sha]
+                for path, edits in edits_by_path.items():
+                    original: Optional[bytes] = None
+                    for sha in read_shas:
                         try:
-                            existing = repo.get_contents(path, ref=branch)
+                            original = _read_file_at(repo, sha, path)
+                            break
                         except GithubException:
-                            existing = repo.get_contents(path, ref=base)
-                        original = (existing.decoded_content or b"").decode("utf-8", errors="ignore")
-                    except GithubException:
+                            continue
+                    if original is None:
                         return f"Target file not found for replacement: {path}"
 
-                    # Apply replacement
-                    if count is None:
-                        updated = original.replace(find_text, replace_text)
-                    else:
-                        updated = original
-                        remaining = count
-                        start = 0
-                        while remaining and (idx := updated.find(find_text, start)) != -1:
-                            updated = updated[:idx] + replace_text + updated[idx + len(find_text) :]
-                            start = idx + len(replace_text)
-                            remaining -= 1
-
+                    updated = _apply_replacements(original, edits)
                     if updated == original:
                         # No-op replacement, continue but informative result
                         continue
 
-                    commit_message = f"{title} (surgical edit)"
-                    repo.update_file(
-                        path=path,
-                        message=commit_message,
-                        content=updated,
-                        sha=existing.sha,
-                        branch=branch,
-                    )
+                    pending[path] = updated
+                commit_message = f"{title} (surgical edit)"
             elif changes:
                 # Create or update files using full content (fallback)
+                messages: List[str] = []
                 for change in changes:
                     # Accept either dicts or FileChange-like objects
                     if isinstance(change, dict):
@@ -230,26 +579,99 @@ class CreatePullRequestTool(BaseTool):
                     if not path:
                         return "Invalid change item: missing 'path'"
 
-                    try:
-                        existing = repo.get_contents(path, ref=branch)
-                        repo.update_file(
-                            path=path,
-                            message=message,
-                            content=content,
-                            sha=existing.sha,
-                            branch=branch,
-                        )
-                    except GithubException:
-                        repo.create_file(
-                            path=path,
-                            message=message,
-                            content=content,
-                            branch=branch,
-                        )
-
-            pr = repo.create_pull(title=title, body=body, head=branch, base=base)
+                    # The tree API creates or overwrites, so no existence check is needed
+                    pending[path] = content.encode("utf-8")
+                    if message not in messages:
+                        messages.append(message)
+                commit_message = messages[0] if len(messages) == 1 else title
+
+            if pending:
+                self._commit_files(repo, branch_ref, pending, commit_message)
+
+            if branch_existed:
+                # A retried run lands on the same branch; its edits are committed above, so
+                # reuse the open PR instead of failing to create a duplicate
+                owner = owner_repo.split("/", 1)[0]
+                open_pulls = repo.get_pulls(state="open", head=f"{owner}:{branch}", base=base)
+                # PaginatedList is lazy; the request happens on first iteration
+                existing_pr = _gh_retry(lambda: next(iter(open_pulls), None))
+                if existing_pr is not None:
+                    return f"PR created: {existing_pr.html_url}"
+
+            pr = _gh_retry(repo.create_pull, title=title, body=body, head=branch, base=base)
             return f"PR created: {pr.html_url}"
         except GithubException as e:
             return f"Failed to create PR: {e}"
 
+    @staticmethod
+    def _content_key(
+        title: str,
+        body: str,
+        changes: Optional[List[Any]],
+        replacements: Optional[List[Any]],
+    ) -> str:
+        """Stable short hash of the PR request, so retries of the same request share a branch."""
+
+        def as_dict(item: Any) -> Any:
+            return item.model_dump() if isinstance(item, BaseModel) else item
+
+        payload = json.dumps(
+            {
+                "changes": [as_dict(c) for c in changes or []],
+                "replacements": [as_dict(r) for r in replacements or []],
+            },
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha1(f"{title}\x00{body}\x00{payload}".encode("utf-8")).hexdigest()[:10]
+
+    @staticmethod
+    def _commit_files(repo: Any, branch_ref: Any, files: Dict[str, bytes], message: str) -> None:
+        """Commit all files on top of the branch head as one commit: tree, commit, ref update."""
+        head = _gh_retry(repo.get_git_commit, branch_ref.object.sha)
+        # Keep each existing file's mode (executable bit, symlink); new files are regular
+        modes = CreatePullRequestTool._file_modes(repo, head.tree.sha, files)
+        elements = []
+        for path, content in files.items():
+            mode = modes.get(path, "100644")
+            try:
+                elements.append(InputGitTreeElement(path, mode, "blob", content=content.decode("utf-8")))
+            except UnicodeDecodeError:
+                # Inline tree content must be text; upload non-UTF-8 files as base64 blobs
+                blob = _gh_retry(repo.create_git_blob, base64.b64encode(content).decode("ascii"), "base64")
+                elements.append(InputGitTreeElement(path, mode, "blob", sha=blob.sha))
+        tree = _gh_retry(repo.create_git_tree, elements, base_tree=head.tree)
+        if tree.sha == head.tree.sha:
+            return  # A retry re-sent content the branch already has; don't add an empty commit
+        commit = _gh_retry(repo.create_git_commit, message=message, tree=tree, parents=[head])
+        _gh_retry(branch_ref.edit, sha=commit.sha)
+        for path, content in files.items():
+            _cache_file(repo.full_name, commit.sha, path, content)
+
+    @staticmethod
+    def _file_modes(repo: Any, root_tree_sha: str, paths: Iterable[str]) -> Dict[str, str]:
+        """Blob modes for the given paths, listing only their parent directories non-recursively."""
+
+        def entries_of(tree_sha: str) -> Dict[str, Any]:
+            return {entry.path: entry for entry in _gh_retry(repo.get_git_tree, tree_sha).tree}
+
+        # Directory path -> its entries by name; each tree is fetched at most once
+        listings: Dict[str, Dict[str, Any]] = {"": entries_of(root_tree_sha)}
+
+        def listing(directory: str) -> Dict[str, Any]:
+            if directory not in listings:
+                parent, _, name = directory.rpartition("/")
+                subtree = listing(parent).get(name)
+                # A directory missing from the head is new, so everything under it is new too
+                listings[directory] = entries_of(subtree.sha) if subtree and subtree.type == "tree" else {}
+            return listings[directory]
+
+        modes: Dict[str, str] = {}
+        for path in paths:
+            directory, _, name = path.rpartition("/")
+            entry = listing(directory).get(name)
+            if entry is not None and entry.type == "blob":
+                modes[path] = entry.mode
+        return modes
+
 
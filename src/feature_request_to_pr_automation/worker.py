@@ -1,24 +1,53 @@
+import asyncio
+import io
 import os
 import time
-import json
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 from datetime import datetime, timezone
+from functools import lru_cache
 from typing import Optional
 
+import requests
 from dotenv import load_dotenv
 from supabase import create_client, Client
 from github import Github
 import smtplib
-from email.mime.text import MIMEText
+from email.message import EmailMessage
 from email.utils import formataddr
 
 from feature_request_to_pr_automation.crew import FeatureRequestToPrAutomationCrew
+from feature_request_to_pr_automation.github_utils import conditional_get, thread_client
 
 
 # Load .env from project root if present
 load_dotenv()
 
 
+_PR_CREATED_RE = re.compile(r"PR\s+created:\s*(https?://\S+)", re.IGNORECASE)
+_PR_URL_RE = re.compile(r"https?://github\.com/\S+/pull/\d+")
+_PR_PARSE_RE = re.compile(r"https?://github\.com/([^/]+)/([^/]+)/pull/(\d+)")
+# A blank or whitespace-only line; GitHub PR bodies often use CRLF
+_BLANK_LINE_RE = re.compile(r"\n[^\S\n]*\n")
+
+_GITHUB_GRAPHQL_URL = "https://api.github.com/graphql"
+_PR_GRAPHQL_FIELDS = "merged mergedAt title body additions deletions files(first: 5) { nodes { path } }"
+
+# Seconds a PR lookup is reused across polling cycles
+_CACHE_TTL = 600
+_CACHE_MAX_ENTRIES = 500
+# Concurrent REST lookups for PRs the GraphQL prefetch did not cover
+_PR_LOOKUP_WORKERS = 8
+_pr_lookup_pool = ThreadPoolExecutor(max_workers=_PR_LOOKUP_WORKERS, thread_name_prefix="pr-lookup")
+
+# Rows each merge/notification scan looks at per cycle
+_SCAN_LIMIT = 100
+# Only the columns the merge/notification scanners read from a feature_requests row.
+_NOTIFY_COLUMNS = "id,pr_url,email,name,message,should_email_user,user_emailed,pr_merged"
+
+
 def _get_env(name: str, required: bool = True, default: Optional[str] = None) -> Optional[str]:
     value = os.getenv(name, default)
     if required and not value:
@@ -33,8 +62,12 @@ def _dbg_enabled() -> bool:
         return False
 
 
+# Read once; call sites check it before building their f-strings
+_DBG = _dbg_enabled()
+
+
 def _dbg(msg: str) -> None:
-    if _dbg_enabled():
+    if _DBG:
         print(f"[debug] {msg}")
 
 
@@ -42,11 +75,11 @@ def _extract_pr_url(text: str) -> Optional[str]:
     if not text:
         return None
     # Prefer lines like "PR created: <url>"
-    m = re.search(r"PR\s+created:\s*(https?://[^\s]+)", text, flags=re.IGNORECASE)
+    m = _PR_CREATED_RE.search(text)
     if m:
         return m.group(1)
     # Fallback: any GitHub PR URL
-    m = re.search(r"https?://github\.com/[^\s]+/pull/\d+", text)
+    m = _PR_URL_RE.search(text)
     return m.group(0) if m else None
 
 
@@ -68,23 +101,56 @@ def _normalize_row(data) -> Optional[dict]:
     return data
 
 
+@dataclass(slots=True)
+class _RowView:
+    """The feature_requests fields the worker reads, normalized once per row."""
+
+    id: str
+    name: str = ""
+    email: str = ""
+    message: str = ""
+    pr_url: str = ""
+    should_email_user: bool = False
+    user_emailed: bool = False
+
+    def __post_init__(self) -> None:
+        self.name = (self.name or "").strip()
+        self.email = (self.email or "").strip()
+        self.message = (self.message or "").strip()
+        self.pr_url = (self.pr_url or "").strip()
+        self.should_email_user = bool(self.should_email_user)
+        self.user_emailed = bool(self.user_emailed)
+
+    @classmethod
+    def from_row(cls, row: dict) -> "_RowView":
+        return cls(
+            id=row["id"],
+            name=row.get("name"),
+            email=row.get("email"),
+            message=row.get("message"),
+            pr_url=row.get("pr_url"),
+            should_email_user=row.get("should_email_user"),
+            user_emailed=row.get("user_emailed"),
+        )
+
+
 def _claim_next(client: Client, worker_id: str) -> Optional[dict]:
     _dbg("RPC claim_next_feature_request()")
     res = client.rpc("claim_next_feature_request", {"p_worker_id": worker_id}).execute()
     row = _normalize_row(res.data)
-    _dbg(f"RPC returned: {'row found' if row else 'no row'}")
+    if _DBG:
+        _dbg(f"RPC returned: {'row found' if row else 'no row'}")
     return row
 
 
 def _update_row(client: Client, row_id: str, values: dict) -> None:
-    _dbg(f"Updating row {row_id} with {list(values.keys())}")
+    if _DBG:
+        _dbg(f"Updating row {row_id} with {list(values.keys())}")
     client.table("feature_requests").update(values).eq("id", row_id).execute()
 
 
-def _build_inputs(row: dict) -> dict:
-    message: str = (row.get("message") or "").strip()
-    name: str = (row.get("name") or "").strip()
-    email: str = (row.get("email") or "").strip()
+def _build_inputs(row: _RowView) -> dict:
+    message, name, email = row.message, row.name, row.email
 
     title = (message[:72] + "…") if len(message) > 72 else (message or "User feedback")
     repo_url = _get_env("GITHUB_REPO_URL", required=False) or ""
@@ -100,32 +166,167 @@ def _build_inputs(row: dict) -> dict:
 
 
 def _github_client() -> Github:
-    token = _get_env("GITHUB_TOKEN", required=False)
-    _dbg(f"GitHub client created; token={'set' if token else 'unset'}")
-    return Github(login_or_token=token) if token else Github()
+    # Lookup threads come from the long-lived _pr_lookup_pool, so each keeps its client
+    return thread_client(_get_env("GITHUB_TOKEN", required=False))
+
+
+@lru_cache(maxsize=1)
+def _crew_template():
+    # Building the crew parses the YAML configs and constructs agents, tools and LLMs; do it once
+    _dbg("Assembling crew")
+    return FeatureRequestToPrAutomationCrew().crew()
 
 
 def _parse_pr_url(pr_url: str) -> Optional[tuple[str, str, int]]:
     # https://github.com/{owner}/{repo}/pull/{number}
-    m = re.match(r"https?://github\.com/([^/]+)/([^/]+)/pull/(\d+)", pr_url)
+    m = _PR_PARSE_RE.match(pr_url)
     if not m:
         return None
     owner, repo, num = m.group(1), m.group(2), int(m.group(3))
     return owner, repo, num
 
 
-def _check_pr_merged(gh: Github, pr_url: str) -> tuple[bool, Optional[str]]:
+# pr_url -> (monotonic time first stored, merged status and/or email details)
+_PR_CACHE: dict[str, tuple[float, dict]] = {}
+_PR_CACHE_LOCK = threading.Lock()
+
+
+def _pr_cache_get(pr_url: str, field: str) -> Optional[dict]:
+    entry = _PR_CACHE.get(pr_url)
+    if entry and time.monotonic() - entry[0] < _CACHE_TTL and field in entry[1]:
+        return entry[1]
+    return None
+
+
+def _pr_cache_put(pr_url: str, values: dict) -> None:
+    now = time.monotonic()
+    with _PR_CACHE_LOCK:
+        if len(_PR_CACHE) >= _CACHE_MAX_ENTRIES:
+            for url in [u for u, (ts, _) in _PR_CACHE.items() if now - ts >= _CACHE_TTL]:
+                del _PR_CACHE[url]
+        entry = _PR_CACHE.get(pr_url)
+        if entry and now - entry[0] < _CACHE_TTL:
+            _PR_CACHE[pr_url] = (entry[0], {**entry[1], **values})
+        else:
+            _PR_CACHE[pr_url] = (now, dict(values))
+
+
+# PR API path -> (ETag, trimmed body of the last 200); 304 revalidations don't count against the rate limit
+_PR_ETAG_CACHE: dict[str, tuple[str, dict]] = {}
+_PR_JSON_FIELDS = ("url", "merged", "merged_at", "title", "body", "additions", "deletions")
+
+
+def _iso_timestamp(value: Optional[str]) -> Optional[str]:
+    # GitHub returns "2024-01-02T03:04:05Z"; store the same +00:00 form PyGithub's datetimes produced
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).isoformat() if value else None
+
+
+def _get_pr_json(gh: Github, owner: str, repo: str, num: int) -> dict:
+    """GET a pull request, revalidating a previously seen one with If-None-Match."""
+    path = f"/repos/{owner}/{repo}/pulls/{num}"
+    cached = _PR_ETAG_CACHE.get(path)
+    etag, data = conditional_get(gh.requester, path, cached[0] if cached else None)
+    if data is None and cached:
+        if _DBG:
+            _dbg(f"PR {owner}/{repo}#{num} not modified")
+        return cached[1]
+
+    pr = {k: data.get(k) for k in _PR_JSON_FIELDS}
+    if etag:
+        with _PR_CACHE_LOCK:
+            if len(_PR_ETAG_CACHE) >= _CACHE_MAX_ENTRIES:
+                _PR_ETAG_CACHE.pop(next(iter(_PR_ETAG_CACHE)))
+            _PR_ETAG_CACHE[path] = (etag, pr)
+    return pr
+
+
+def _prefetch_pr_details(pr_urls: list[str]) -> dict[str, dict]:
+    """Fetch merge status and email details for many PRs in one GraphQL request.
+
+    Returns {pr_url: details} for the PRs GitHub resolved; callers fall back to REST
+    lookups for anything missing (no token, request failure, deleted PR).
+    """
+    token = _get_env("GITHUB_TOKEN", required=False)
+    # PRs whose full details are still cached need no request at all
+    parsed = {url: _parse_pr_url(url) for url in dict.fromkeys(pr_urls) if not _pr_cache_get(url, "title")}
+    targets = [(url, p) for url, p in parsed.items() if p]
+    if not token or not targets:
+        return {}
+
+    var_decls: list[str] = []
+    fields: list[str] = []
+    variables: dict = {}
+    for i, (_, (owner, repo, num)) in enumerate(targets):
+        var_decls.append(f"$o{i}: String!, $r{i}: String!, $n{i}: Int!")
+        fields.append(f"pr{i}: repository(owner: $o{i}, name: $r{i}) {{ pullRequest(number: $n{i}) {{ {_PR_GRAPHQL_FIELDS} }} }}")
+        variables.update({f"o{i}": owner, f"r{i}": repo, f"n{i}": num})
+    query = f"query({', '.join(var_decls)}) {{ {' '.join(fields)} }}"
+
+    try:
+        if _DBG:
+            _dbg(f"GraphQL prefetch for {len(targets)} PRs")
+        resp = requests.post(
+            _GITHUB_GRAPHQL_URL,
+            json={"query": query, "variables": variables},
+            headers={"Authorization": f"Bearer {token}"},
+            timeout=20,
+        )
+        resp.raise_for_status()
+        data = resp.json().get("data") or {}
+    except Exception as e:
+        print(f"[merge-check] GraphQL prefetch failed; falling back to REST: {e}")
+        return {}
+
+    details_by_url: dict[str, dict] = {}
+    for i, (url, _) in enumerate(targets):
+        pr = ((data.get(f"pr{i}") or {}).get("pullRequest")) or None
+        if not pr:
+            continue
+        details_by_url[url] = {
+            "merged": bool(pr.get("merged")),
+            "merged_at": _iso_timestamp(pr.get("mergedAt")),
+            "title": pr.get("title") or None,
+            "body": (pr.get("body") or "").strip() or None,
+            "additions": pr.get("additions"),
+            "deletions": pr.get("deletions"),
+            "files": [n["path"] for n in ((pr.get("files") or {}).get("nodes") or []) if n],
+        }
+        _pr_cache_put(url, details_by_url[url])
+    return details_by_url
+
+
+def _check_pr_merged(
+    gh: Github, pr_url: str, prefetched: Optional[dict] = None, with_details: bool = False
+) -> tuple[bool, Optional[str]]:
+    details = (prefetched or {}).get(pr_url)
+    if not details or "merged" not in details:
+        details = _pr_cache_get(pr_url, "merged")
+    if details:
+        if details["merged"]:
+            merged_at = details["merged_at"] or _now_iso()
+            print(f"[merge-check] PR merged: {pr_url} at {merged_at}")
+            return True, merged_at
+        print(f"[merge-check] PR not merged yet: {pr_url}")
+        return False, None
+
     parsed = _parse_pr_url(pr_url)
     if not parsed:
         print(f"[merge-check] Could not parse PR URL: {pr_url}")
         return False, None
     owner, repo, num = parsed
     try:
-        _dbg(f"Checking PR merged status for {owner}/{repo}#{num}")
-        r = gh.get_repo(f"{owner}/{repo}")
-        pr = r.get_pull(num)
-        if pr.merged:
-            merged_at = pr.merged_at.isoformat() if pr.merged_at else _now_iso()
+        if _DBG:
+            _dbg(f"Checking PR merged status for {owner}/{repo}#{num}")
+        pr = _get_pr_json(gh, owner, repo, num)
+        details = {"merged": bool(pr["merged"]), "merged_at": _iso_timestamp(pr["merged_at"])}
+        if details["merged"] and with_details:
+            # The caller is about to email about this PR; keep its details so that needs no second lookup
+            details.update(_pr_details_from(gh, pr))
+            if prefetched is not None:
+                prefetched[pr_url] = details
+        _pr_cache_put(pr_url, details)
+        if details["merged"]:
+            merged_at = details["merged_at"] or _now_iso()
             print(f"[merge-check] PR merged: {pr_url} at {merged_at}")
             return True, merged_at
         print(f"[merge-check] PR not merged yet: {pr_url}")
@@ -135,36 +336,49 @@ def _check_pr_merged(gh: Github, pr_url: str) -> tuple[bool, Optional[str]]:
         return False, None
 
 
-def _get_pr_details(gh: Github, pr_url: str) -> dict:
+def _pr_details_from(gh: Github, pr: dict) -> dict:
+    files = []
+    try:
+        # One page of five files instead of PaginatedList's default page of 30
+        _, data = gh.requester.requestJsonAndCheck("GET", f"{pr['url']}/files", parameters={"per_page": 5})
+        files = [f["filename"] for f in data or []]
+    except Exception:
+        pass
+    return {
+        "title": pr["title"] or None,
+        "body": (pr["body"] or "").strip() or None,
+        "additions": pr["additions"],
+        "deletions": pr["deletions"],
+        "files": files,
+    }
+
+
+def _get_pr_details(gh: Github, pr_url: str, prefetched: Optional[dict] = None) -> dict:
+    cached = (prefetched or {}).get(pr_url)
+    if not cached or "title" not in cached:
+        cached = _pr_cache_get(pr_url, "title")
+    if cached:
+        return cached
     details = {"title": None, "body": None, "files": [], "additions": None, "deletions": None}
     parsed = _parse_pr_url(pr_url)
     if not parsed:
         return details
     try:
         owner, repo, num = parsed
-        r = gh.get_repo(f"{owner}/{repo}")
-        pr = r.get_pull(num)
-        details["title"] = pr.title or None
-        details["body"] = (pr.body or "").strip() or None
-        details["additions"] = pr.additions
-        details["deletions"] = pr.deletions
-        files = []
-        try:
-            for f in pr.get_files()[:5]:
-                files.append(f.filename)
-        except Exception:
-            pass
-        details["files"] = files
+        details = _pr_details_from(gh, _get_pr_json(gh, owner, repo, num))
+        _pr_cache_put(pr_url, details)
     except Exception:
         pass
+    if prefetched is not None:
+        prefetched[pr_url] = details
     return details
 
 
-def _build_email_body(row: dict, pr_url: str) -> tuple[str, str]:
+def _build_email_body(row: _RowView, pr_url: str, prefetched: Optional[dict] = None) -> tuple[str, str]:
     gh = _github_client()
-    pr = _get_pr_details(gh, pr_url)
-    name = row.get("name") or "there"
-    message = (row.get("message") or "").strip()
+    pr = _get_pr_details(gh, pr_url, prefetched)
+    name = row.name or "there"
+    message = row.message
 
     # Plain-English summary and subject
     fallback_summary = (message[:80] + "…") if len(message) > 80 else (message or "Your request was implemented")
@@ -172,55 +386,37 @@ def _build_email_body(row: dict, pr_url: str) -> tuple[str, str]:
     subject = f"hireCrew Feature Request: {summary}"
 
     # Build a concise body with PR details
-    lines = [
-        f"Hi {name},",
-        "",
-        "Your requested change has been merged and is live.",
-        "",
-        f"Summary: {summary}",
-        "",
-    ]
+    buf = io.StringIO()
+    w = buf.write
+    w(f"Hi {name},\n\nYour requested change has been merged and is live.\n\nSummary: {summary}\n\n")
 
     if message:
-        lines.append(f"Request: {message}")
+        w(f"Request: {message}\n")
     if pr_url:
-        lines.append(f"Pull Request: {pr_url}")
+        w(f"Pull Request: {pr_url}\n")
 
     files = pr.get("files") or []
     additions = pr.get("additions")
     deletions = pr.get("deletions")
 
     if files or (additions is not None) or (deletions is not None):
-        lines.append("")
-        lines.append("What changed:")
-        if files:
-            for f in files:
-                lines.append(f"- {f}")
+        w("\nWhat changed:\n")
+        for f in files:
+            w(f"- {f}\n")
         if (additions is not None) or (deletions is not None):
-            lines.append(f"- Diff stats: +{additions or 0} / -{deletions or 0}")
+            w(f"- Diff stats: +{additions or 0} / -{deletions or 0}\n")
 
     pr_body = (pr.get("body") or "").strip()
     if pr_body:
-        first_para = pr_body.splitlines()
-        excerpt = []
-        for ln in first_para:
-            if ln.strip() == "" and excerpt:
-                break
-            excerpt.append(ln)
-        excerpt_text = "\n".join(excerpt).strip()
+        excerpt_text = _BLANK_LINE_RE.split(pr_body, 1)[0].replace("\r\n", "\n").strip()
         if excerpt_text:
-            lines.append("")
-            lines.append("Details:")
-            lines.append(excerpt_text)
-
-    lines.append("")
-    lines.append("Thank you for helping improve hireCrew!")
+            w(f"\nDetails:\n{excerpt_text}\n")
 
-    body = "\n".join(lines)
-    return subject, body
+    w("\nThank you for helping improve hireCrew!")
+    return subject, buf.getvalue()
 
 
-def _send_email(to_email: str, subject: str, body: str) -> bool:
+def _smtp_config() -> Optional[dict]:
     host = _get_env("SMTP_HOST", required=False)
     user = _get_env("SMTP_USER", required=False)
     password = _get_env("SMTP_PASS", required=False)
@@ -229,173 +425,280 @@ def _send_email(to_email: str, subject: str, body: str) -> bool:
     debug = int(os.getenv("SMTP_DEBUG", "0"))
 
     if not host or not from_addr:
-        print("[email] SMTP not configured; skipping send")
-        return False
-
-    _dbg(f"SMTP config host={host} port={port} from={from_addr} to={to_email} user={'set' if user else 'unset'} mode={'SSL' if port==465 else 'STARTTLS/PLAIN'}")
-
-    msg = MIMEText(body, "plain", "utf-8")
+        return None
+    return {"host": host, "user": user, "password": password, "from_addr": from_addr, "port": port, "debug": debug}
+
+
+def _open_smtp(cfg: dict) -> smtplib.SMTP:
+    host, port, user, password = cfg["host"], cfg["port"], cfg["user"], cfg["password"]
+    if _DBG:
+        _dbg(f"SMTP config host={host} port={port} from={cfg['from_addr']} user={'set' if user else 'unset'} mode={'SSL' if port==465 else 'STARTTLS/PLAIN'}")
+
+    if port == 465:
+        _dbg("Opening SMTP_SSL connection")
+        server: smtplib.SMTP = smtplib.SMTP_SSL(host, port, timeout=20)
+        if cfg["debug"]:
+            server.set_debuglevel(1)
+        if user and password:
+            _dbg("Logging in (SSL)")
+            server.login(user, password)
+        return server
+
+    _dbg("Opening SMTP connection")
+    server = smtplib.SMTP(host, port, timeout=20)
+    if cfg["debug"]:
+        server.set_debuglevel(1)
+    try:
+        _dbg("EHLO")
+        server.ehlo()
+    except Exception as e:
+        if _DBG:
+            _dbg(f"EHLO failed: {e}")
+    try:
+        _dbg("STARTTLS")
+        server.starttls()
+        try:
+            _dbg("EHLO after STARTTLS")
+            server.ehlo()
+        except Exception as e:
+            if _DBG:
+                _dbg(f"EHLO-after-STARTTLS failed: {e}")
+    except Exception as e:
+        if _DBG:
+            _dbg(f"STARTTLS skipped/failed: {e}")
+    if user and password:
+        _dbg("Logging in")
+        server.login(user, password)
+    return server
+
+
+def _send_email_on(server: smtplib.SMTP, from_addr: str, to_email: str, subject: str, body: str) -> None:
+    msg = EmailMessage()
+    # quoted-printable stays 7-bit clean for relays without 8BITMIME, as MIMEText's base64 was
+    msg.set_content(body, cte="quoted-printable")
     msg["Subject"] = subject
     msg["From"] = formataddr(("hireCrew", from_addr))
     msg["To"] = to_email
 
-    try:
-        if port == 465:
-            _dbg("Opening SMTP_SSL connection")
-            with smtplib.SMTP_SSL(host, port, timeout=20) as server:
-                if debug:
-                    server.set_debuglevel(1)
-                if user and password:
-                    _dbg("Logging in (SSL)")
-                    server.login(user, password)
-                _dbg("Sending email (SSL)")
-                server.sendmail(from_addr, [to_email], msg.as_string())
-        else:
-            _dbg("Opening SMTP connection")
-            with smtplib.SMTP(host, port, timeout=20) as server:
-                if debug:
-                    server.set_debuglevel(1)
-                try:
-                    _dbg("EHLO")
-                    server.ehlo()
-                except Exception as e:
-                    _dbg(f"EHLO failed: {e}")
-                try:
-                    _dbg("STARTTLS")
-                    server.starttls()
-                    try:
-                        _dbg("EHLO after STARTTLS")
-                        server.ehlo()
-                    except Exception as e:
-                        _dbg(f"EHLO-after-STARTTLS failed: {e}")
-                except Exception as e:
-                    _dbg(f"STARTTLS skipped/failed: {e}")
-                if user and password:
-                    _dbg("Logging in")
-                    server.login(user, password)
-                _dbg("Sending email")
-                server.sendmail(from_addr, [to_email], msg.as_string())
-        print(f"[email] Sent to {to_email}")
-        return True
-    except Exception as e:
-        print(f"[email] Failed to send to {to_email}: {e}")
-        return False
+    if _DBG:
+        _dbg(f"Sending email to {to_email}")
+    server.send_message(msg, from_addr=from_addr, to_addrs=[to_email])
+
+
+class _SmtpSession:
+    """SMTP connection shared by a batch of emails.
+
+    Connects and authenticates on the first send only, reconnects once if the server
+    drops the connection mid-batch, and closes on exit.
+    """
 
+    def __init__(self) -> None:
+        self._cfg = _smtp_config()
+        self._server: Optional[smtplib.SMTP] = None
 
-def _check_and_notify_merges(client: Client) -> None:
-    # Fetch recent done requests; filter in Python for simplicity
-    _dbg("Fetching recent 'done' requests for merge check")
+    def __enter__(self) -> "_SmtpSession":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+            self._server = None
+
+    def send(self, to_email: str, subject: str, body: str) -> bool:
+        if not self._cfg:
+            print("[email] SMTP not configured; skipping send")
+            return False
+        try:
+            for attempt in range(2):
+                if self._server is None:
+                    self._server = _open_smtp(self._cfg)
+                try:
+                    _send_email_on(self._server, self._cfg["from_addr"], to_email, subject, body)
+                    break
+                except smtplib.SMTPServerDisconnected:
+                    _dbg("SMTP connection dropped; reconnecting")
+                    self._server = None
+                    if attempt:
+                        raise
+            print(f"[email] Sent to {to_email}")
+            return True
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError) as e:
+            print(f"[email] Failed to send to {to_email}: {e}")
+            return False
+        except Exception as e:
+            print(f"[email] Failed to send to {to_email}: {e}")
+            self.close()
+            return False
+
+
+def _check_and_notify_merges(client: Client, pr_detail_cache: Optional[dict] = None) -> set:
+    """Record newly merged PRs and email opted-in users.
+
+    Returns the ids of rows an email was attempted for, so the pending-notification
+    scan in the same cycle can skip them.
+    """
+    # Fetch recent done requests that have a PR which is not yet known to be merged
+    _dbg("Fetching recent unmerged 'done' requests for merge check")
     res = (
         client
         .table("feature_requests")
-        .select("*")
+        .select(_NOTIFY_COLUMNS)
         .eq("status", "done")
+        .not_.is_("pr_url", "null")
+        .not_.is_("pr_merged", "true")
         .order("created_at", desc=True)
-        .limit(100)
+        .limit(_SCAN_LIMIT)
         .execute()
     )
-    all_rows = res.data or []
-    _dbg(f"Fetched {len(all_rows)} rows")
-    rows = [
-        r for r in all_rows
-        if r.get("pr_url") and not bool(r.get("pr_merged"))
-    ]
-    _dbg(f"Filtered to {len(rows)} rows with pr_url and not merged")
+    rows = [v for v in map(_RowView.from_row, res.data or []) if v.pr_url]
+    if _DBG:
+        _dbg(f"Fetched {len(rows)} rows with pr_url and not merged")
+    notified_ids: set = set()
     if not rows:
-        return
-
-    gh = _github_client()
-
-    for row in rows:
-        pr_url = row.get("pr_url")
-        if not pr_url:
-            continue
-
-        merged, merged_at = _check_pr_merged(gh, pr_url)
-        if not merged:
-            continue
-
-        updates = {
-            "pr_merged": True,
-            "merged_at": merged_at or _now_iso(),
-        }
-
-        # Email if opted-in and not yet emailed
-        should_email = bool(row.get("should_email_user"))
-        already_emailed = bool(row.get("user_emailed"))
-        email = (row.get("email") or "").strip()
-        _dbg(
-            f"Notify? should_email={should_email} already_emailed={already_emailed} email_present={'yes' if email else 'no'}"
-        )
-        if should_email and not already_emailed and email:
-            subject, body = _build_email_body(row, pr_url)
-            sent = _send_email(email, subject, body)
-            if sent:
-                updates["user_emailed"] = True
-
-        _update_row(client, row["id"], updates)
-        print(f"[merge-check] Updated row {row['id']} with merged info and notifications")
-
-
-def _send_pending_notifications(client: Client) -> None:
+        return notified_ids
+
+    prefetched = {} if pr_detail_cache is None else pr_detail_cache
+    prefetched.update(_prefetch_pr_details([r.pr_url for r in rows if r.pr_url not in prefetched]))
+
+    # PRs missing from the prefetch fall back to REST; overlap those round trips.
+    # Each lookup thread uses its own client (see _github_client).
+    merged_at_by_id: dict = {}
+    futures = {
+        _pr_lookup_pool.submit(
+            lambda url, wants_email: _check_pr_merged(_github_client(), url, prefetched, wants_email),
+            r.pr_url,
+            r.should_email_user and not r.user_emailed and bool(r.email),
+        ): r
+        for r in rows
+    }
+    for fut in as_completed(futures):
+        merged, merged_at = fut.result()
+        if merged:
+            merged_at_by_id[futures[fut].id] = merged_at
+
+    detail_urls = [
+        r.pr_url for r in rows
+        if r.id in merged_at_by_id
+        and r.should_email_user and not r.user_emailed and r.email
+        and r.pr_url not in prefetched
+    ]
+    list(_pr_lookup_pool.map(lambda u: _get_pr_details(_github_client(), u, prefetched), detail_urls))
+
+    with _SmtpSession() as smtp:
+        for row in rows:
+            pr_url = row.pr_url
+            if row.id not in merged_at_by_id:
+                continue
+
+            updates = {
+                "pr_merged": True,
+                "merged_at": merged_at_by_id[row.id] or _now_iso(),
+            }
+
+            # Email if opted-in and not yet emailed
+            if _DBG:
+                _dbg(
+                    f"Notify? should_email={row.should_email_user} already_emailed={row.user_emailed} email_present={'yes' if row.email else 'no'}"
+                )
+            if row.should_email_user and not row.user_emailed and row.email:
+                notified_ids.add(row.id)
+                subject, body = _build_email_body(row, pr_url, prefetched)
+                sent = smtp.send(row.email, subject, body)
+                if sent:
+                    updates["user_emailed"] = True
+                    _PR_CACHE.pop(pr_url, None)
+
+            _update_row(client, row.id, updates)
+            print(f"[merge-check] Updated row {row.id} with merged info and notifications")
+    return notified_ids
+
+
+def _send_pending_notifications(
+    client: Client, pr_detail_cache: Optional[dict] = None, skip_ids: Optional[set] = None
+) -> None:
     # Send emails for already-merged rows where user asked to be notified but hasn't been emailed
+    skip_ids = skip_ids or set()
+    if len(skip_ids) >= _SCAN_LIMIT:
+        # The merge check already attempted a full scan's worth of emails; the rest wait a cycle
+        _dbg("Skipping pending notifications; merge check covered this cycle")
+        return
     _dbg("Checking pending notifications for merged rows")
     res = (
         client
         .table("feature_requests")
-        .select("*")
+        .select(_NOTIFY_COLUMNS)
         .eq("pr_merged", True)
         .eq("should_email_user", True)
         .eq("user_emailed", False)
         .order("created_at", desc=True)
-        .limit(100)
+        .limit(_SCAN_LIMIT)
         .execute()
     )
-    rows = res.data or []
-    _dbg(f"Pending notifications: {len(rows)} rows")
+    # Rows the merge check just tried (sent, or failed to send) are not retried in the same cycle
+    rows = [v for v in map(_RowView.from_row, res.data or []) if v.id not in skip_ids]
+    if _DBG:
+        _dbg(f"Pending notifications: {len(rows)} rows")
     if not rows:
         return
 
-    gh = _github_client()
+    prefetched = {} if pr_detail_cache is None else pr_detail_cache
+    prefetched.update(
+        _prefetch_pr_details([r.pr_url for r in rows if r.pr_url and r.pr_url not in prefetched])
+    )
 
-    for row in rows:
-        email = (row.get("email") or "").strip()
-        pr_url = row.get("pr_url")
-        if not email or not pr_url:
-            continue
-        subject, body = _build_email_body(row, pr_url)
-        sent = _send_email(email, subject, body)
-        if sent:
-            _update_row(client, row["id"], {"user_emailed": True})
-            print(f"[email] Marked row {row['id']} as emailed")
+    with _SmtpSession() as smtp:
+        for row in rows:
+            if not row.email or not row.pr_url:
+                continue
+            subject, body = _build_email_body(row, row.pr_url, prefetched)
+            sent = smtp.send(row.email, subject, body)
+            if sent:
+                _PR_CACHE.pop(row.pr_url, None)
+                _update_row(client, row.id, {"user_emailed": True})
+                print(f"[email] Marked row {row.id} as emailed")
 
 
-def process_one(client: Client, worker_id: str, poll_delay_seconds: int = 5) -> None:
+def process_one(
+    client: Client, worker_id: str, poll_delay_seconds: int = 5, wake: Optional[threading.Event] = None
+) -> None:
+    # PR details fetched during this tick, shared by the merge check and pending notifications
+    pr_detail_cache: dict[str, dict] = {}
     row = _claim_next(client, worker_id)
     if not row:
         _dbg("No pending job; running merge-check")
         # Even if no new job, still check merges to notify users
-        _check_and_notify_merges(client)
+        notified_ids = _check_and_notify_merges(client, pr_detail_cache)
         # Also attempt notifications for already-merged rows
-        _send_pending_notifications(client)
-        time.sleep(poll_delay_seconds)
+        _send_pending_notifications(client, pr_detail_cache, skip_ids=notified_ids)
+        if wake:
+            # Return early on an INSERT; clear before the next claim so nothing is missed
+            wake.wait(timeout=poll_delay_seconds)
+            wake.clear()
+        else:
+            time.sleep(poll_delay_seconds)
         return
 
     row_id = row["id"]
-    _dbg(f"Claimed job {row_id}")
+    if _DBG:
+        _dbg(f"Claimed job {row_id}")
     try:
-        crew = FeatureRequestToPrAutomationCrew().crew()
-        inputs = _build_inputs(row)
+        # Fresh task outputs and tool-result cache per job, same as crewAI's kickoff_for_each
+        crew = _crew_template().copy()
+        inputs = _build_inputs(_RowView.from_row(row))
         _dbg("Running crew kickoff")
         result = crew.kickoff(inputs=inputs)
-        # Convert result to string/json for storage
-        try:
-            result_str = str(result)
-        except Exception:
-            result_str = json.dumps(result, default=str)
+        # CrewOutput.raw is the final task's text; one string serves both URL extraction and storage
+        result_str = getattr(result, "raw", None) or str(result)
 
         pr_url = _extract_pr_url(result_str) or None
-        _dbg(f"Extracted PR URL: {pr_url}")
+        if _DBG:
+            _dbg(f"Extracted PR URL: {pr_url}")
 
         _update_row(
             client,
@@ -411,8 +714,8 @@ def process_one(client: Client, worker_id: str, poll_delay_seconds: int = 5) ->
         print(f"Processed {row_id}; PR: {pr_url or 'n/a'}")
 
         # After processing a job, also check merges for notifications
-        _check_and_notify_merges(client)
-        _send_pending_notifications(client)
+        notified_ids = _check_and_notify_merges(client, pr_detail_cache)
+        _send_pending_notifications(client, pr_detail_cache, skip_ids=notified_ids)
     except Exception as e:
         print(f"Error processing {row_id}: {e}")
         _update_row(
@@ -427,6 +730,65 @@ def process_one(client: Client, worker_id: str, poll_delay_seconds: int = 5) ->
         )
 
 
+def _start_job_listener(supabase_url: str, supabase_key: str) -> Optional[threading.Event]:
+    """Subscribe to feature_requests INSERTs via Supabase Realtime on a background thread.
+
+    Returns an event that is set whenever a row is inserted, or None if the subscription
+    could not be established (the worker then keeps polling).
+    """
+    try:
+        from realtime import AsyncRealtimeClient, RealtimeSubscribeStates
+    except Exception as e:
+        print(f"[realtime] Unavailable ({e}); falling back to polling")
+        return None
+
+    wake = threading.Event()
+    ready = threading.Event()
+    failure: list[Exception] = []
+    stop: list = []  # [loop, asyncio.Event] once the listener loop is running
+
+    async def _listen() -> None:
+        stopped = asyncio.Event()
+        stop.extend([asyncio.get_running_loop(), stopped])
+
+        def on_subscribe(state, err: Optional[Exception]) -> None:
+            # subscribe() only sends the join; the server's answer arrives here
+            if state == RealtimeSubscribeStates.SUBSCRIBED:
+                ready.set()
+            elif not ready.is_set():
+                failure.append(err or RuntimeError(str(state)))
+                ready.set()
+                stopped.set()
+            else:
+                print(f"[realtime] Channel {state}; new jobs are only picked up on the idle pass")
+
+        rt = AsyncRealtimeClient(f"{supabase_url.rstrip('/')}/realtime/v1", token=supabase_key)
+        try:
+            await rt.connect()
+            channel = rt.channel("feature_requests")
+            channel.on_postgres_changes(
+                "INSERT", schema="public", table="feature_requests", callback=lambda _payload: wake.set()
+            )
+            await channel.subscribe(on_subscribe)
+        except Exception as e:
+            failure.append(e)
+            ready.set()
+            return
+        # The client's own tasks keep the socket and heartbeats alive; run until told to stop
+        await stopped.wait()
+        await rt.close()
+
+    threading.Thread(target=lambda: asyncio.run(_listen()), name="realtime-listener", daemon=True).start()
+    if not ready.wait(timeout=15) or failure:
+        if stop:
+            loop, stopped = stop
+            loop.call_soon_threadsafe(stopped.set)
+        print(f"[realtime] Subscription failed ({failure[0] if failure else 'timed out'}); falling back to polling")
+        return None
+    _dbg("Subscribed to feature_requests INSERT events")
+    return wake
+
+
 def run_worker() -> None:
     supabase_url = _get_env("SUPABASE_URL")
     supabase_key = _get_env("SUPABASE_SERVICE_ROLE_KEY")
@@ -435,10 +797,26 @@ def run_worker() -> None:
     worker_id = os.getenv("WORKER_ID") or os.getenv("HOSTNAME") or f"local-{os.getpid()}"
     poll_seconds = int(os.getenv("POLL_DELAY_SECONDS", "5"))
 
-    print("CrewAI worker started. Polling Supabase for pending feature requests…")
-    _dbg(f"Worker ID: {worker_id}; Poll every {poll_seconds}s")
+    wake = None
+    # Opt-in: feature_requests must be in the supabase_realtime publication for INSERTs to arrive
+    if os.getenv("SUPABASE_REALTIME", "0") == "1":
+        wake = _start_job_listener(supabase_url, supabase_key)
+
+    if wake:
+        # Realtime wakes the loop on new rows; still run a slow pass for merge checks and missed events
+        idle_seconds = int(os.getenv("REALTIME_IDLE_SECONDS", "60"))
+        print("CrewAI worker started. Waiting for feature requests via Supabase Realtime…")
+        if _DBG:
+            _dbg(f"Worker ID: {worker_id}; Idle pass every {idle_seconds}s")
+    else:
+        print("CrewAI worker started. Polling Supabase for pending feature requests…")
+        if _DBG:
+            _dbg(f"Worker ID: {worker_id}; Poll every {poll_seconds}s")
     while True:
-        process_one(client, worker_id, poll_delay_seconds=poll_seconds)
+        if wake:
+            process_one(client, worker_id, poll_delay_seconds=idle_seconds, wake=wake)
+        else:
+            process_one(client, worker_id, poll_delay_seconds=poll_seconds)
 
 
 if __name__ == "__main__":